@@ -2,10 +2,149 @@
 """Build packages using CMake"""
 
 import argparse
+import concurrent.futures
+import multiprocessing
+import os
 import subprocess
 import sys
+import threading
 from pathlib import Path
 
+# Serializes writes to stdout so concurrent matrix builds stay readable.
+# Replaced with a Manager lock shared across worker processes by main().
+_stdout_lock = threading.Lock()
+
+
+def _set_stdout_lock(lock):
+    """Pool initializer: share one stdout lock across worker processes."""
+    global _stdout_lock
+    _stdout_lock = lock
+
+
+def _log(prefix, text):
+    with _stdout_lock:
+        sys.stdout.write(f"[{prefix}] {text}\n")
+        sys.stdout.flush()
+
+
+def _run_logged(cmd, env, prefix):
+    """Run cmd, prefixing every output line, and return its returncode."""
+    with subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, bufsize=1) as p:
+        for line in p.stdout:
+            with _stdout_lock:
+                sys.stdout.write(f"[{prefix}] {line}")
+                sys.stdout.flush()
+        return p.wait()
+
+
+# Immutable argv prefixes; the per-build parts are appended per matrix entry.
+_BUILD_PREFIX = ("cmake", "--build")
+_INSTALL_PREFIX = ("cmake", "--install")
+
+
+def build_one(preset, build_type, cmake_dir, base_build_dir, stage, packages_str, target_args, env, install, reconfigure, jobs):
+    """Configure, build and optionally install one (preset, build_type) pair.
+
+    Runs in a worker process; each pair writes to its own build_dir so the
+    matrix entries are independent. Returns a cmake returncode (0 on success).
+    """
+    prefix = f"{preset}/{build_type}"
+    build_dir = base_build_dir / f"{stage}" / f"{preset}" / f"{build_type}"
+    build_dir.mkdir(parents=True, exist_ok=True)
+    # Stringify the paths once; they are reused across configure/build/install.
+    cmake_dir_str = str(cmake_dir)
+    build_dir_str = str(build_dir)
+
+    # A successful configure leaves CMakeCache.txt newer than
+    # CMakeLists.txt; in that case the reconfigure would be a no-op
+    # and only costs a cmake process startup + rescan.
+    cache_file = build_dir / "CMakeCache.txt"
+    cmakelists = cmake_dir / "CMakeLists.txt"
+    cmakelists_mtime = cmakelists.stat().st_mtime if cmakelists.exists() else 0
+    needs_configure = (
+        reconfigure
+        or not cache_file.exists()
+        or cache_file.stat().st_mtime < cmakelists_mtime
+    )
+
+    if needs_configure:
+        _log(prefix, f"=== Configuring: packages={packages_str}, stage={stage} ===")
+
+        configure_cmd = [
+            "cmake",
+            "-G", "Ninja",
+            "-S", cmake_dir_str,
+            "-B", build_dir_str
+        ]
+
+        if reconfigure:
+            configure_cmd += ["--fresh"]
+
+        configure_cmd += [
+            f"-DARIEO_BUILD_CONFIGURE_PRESET={preset}",
+            f"-DARIEO_BUILD_CONFIGURE_STAGE={stage}",
+        ]
+
+        if stage == "INSTALL_BUILD_ENV_STAGE":
+            configure_cmd += [
+            ]
+        else:
+            configure_cmd += [
+                f"--preset={preset}",
+                f"-DCMAKE_BUILD_TYPE={build_type}",
+            ]
+
+        # if(base_install_dir):
+        #     configure_cmd += [
+        #         f"-DCMAKE_INSTALL_PREFIX={base_install_dir}"
+        #     ]
+
+        returncode = _run_logged(configure_cmd, env, prefix)
+        if returncode != 0:
+            _log(prefix, f"Configure failed for stage={stage}")
+            return returncode
+    else:
+        _log(prefix, f"=== Configure up to date: stage={stage} (use --reconfigure to force) ===")
+
+    _log(prefix, f"=== Building: packages={packages_str}, stage={stage} ===")
+
+    # Build; all packages go in a single pre-built --target argument list
+    build_cmd = [
+        *_BUILD_PREFIX, build_dir_str,
+        "--config", build_type,
+        "--parallel", jobs,
+        *target_args
+    ]
+
+    # if stage == "INSTALL_BUILD_ENV_STAGE":
+    #     build_cmd += [
+    #     ]
+    # else:
+    #     build_cmd += [
+    #         f"--preset={preset}"
+    #     ]
+
+    returncode = _run_logged(build_cmd, env, prefix)
+    if returncode != 0:
+        _log(prefix, f"Build failed for stage={stage}")
+        return returncode
+
+    if(install):
+        _log(prefix, f"=== Installing: stage={stage} ===")
+        install_cmd = [
+            *_INSTALL_PREFIX, build_dir_str,
+            "--config", build_type
+        ]
+
+        returncode = _run_logged(install_cmd, env, prefix)
+        if returncode != 0:
+            _log(prefix, f"Install failed for stage={stage}")
+            return returncode
+
+    return 0
+
 
 def main():
     parser = argparse.ArgumentParser(description="Build packages using CMake")
@@ -17,6 +156,7 @@ def main():
     parser.add_argument("--package", action="append", default=[], help="Package to build (can be specified multiple times)")
     parser.add_argument("--environment", action="append", default=[], help="Environment variable to set (format: VAR=set:VALUE, VAR=append:VALUE, VAR=prepend:VALUE)")
     parser.add_argument("--stage", default="BUILD_ENGINE_STAGE", help="Build stage (default: BUILD_ENGINE_STAGE)")
+    parser.add_argument("--reconfigure", action="store_true", help="Force a fresh CMake configure even if CMakeCache.txt is up to date")
 
     args = parser.parse_args()
 
@@ -28,11 +168,7 @@ def main():
     stage = args.stage
     install = args.install
 
-    packages_str = ";".join(packages) if packages else ""
-
-
     # Prepare environment variables with set, append, prepend support
-    import os
     env = os.environ.copy()
     for env_arg in args.environment:
         if '=append:' in env_arg:
@@ -45,82 +181,43 @@ def main():
             k, v = env_arg.split('=set:', 1)
             env[k] = v
 
-    for preset in presets:
-        for build_type in build_types:
-            build_dir = base_build_dir / f"{stage}" / f"{preset}" / f"{build_type}"
-            build_dir.mkdir(parents=True, exist_ok=True)
-
-            print(f"\n=== Configuring: preset={preset}, build_type={build_type}, packages={packages_str}, stage={stage} ===")
-
-            configure_cmd = [
-                "cmake",
-                "-G", "Ninja",
-                "-S", str(cmake_dir),
-                "-B", str(build_dir)
-            ]
-
-            configure_cmd += [
-                f"-DARIEO_BUILD_CONFIGURE_PRESET={preset}",
-                f"-DARIEO_BUILD_CONFIGURE_STAGE={stage}",
-            ]
-
-            if stage == "INSTALL_BUILD_ENV_STAGE":
-                configure_cmd += [
-                ]
-            else:
-                configure_cmd += [
-                    f"--preset={preset}",
-                    f"-DCMAKE_BUILD_TYPE={build_type}",
-                ]
-
-            # if(base_install_dir):
-            #     configure_cmd += [
-            #         f"-DCMAKE_INSTALL_PREFIX={base_install_dir}"
-            #     ]
-
-            result = subprocess.run(configure_cmd, env=env, stdin=subprocess.DEVNULL)
-            if result.returncode != 0:
-                print(f"Configure failed for preset={preset}, build_type={build_type}, stage={stage}")
-                return result.returncode
-
-            print(f"\n=== Building: preset={preset}, build_type={build_type}, packages={packages_str}, stage={stage} ===")
-
-            # Build
-            build_cmd = [
-                "cmake",
-                "--build", str(build_dir),
-                "--config", build_type
-            ]
-
-            # if stage == "INSTALL_BUILD_ENV_STAGE":
-            #     build_cmd += [
-            #     ]
-            # else:
-            #     build_cmd += [
-            #         f"--preset={preset}"
-            #     ]
-
-            # Add all packages as a single --target argument (space-separated)
-            if packages:
-                build_cmd.extend(["--target"] + packages)
-
-            result = subprocess.run(build_cmd, env=env, stdin=subprocess.DEVNULL)
-            if result.returncode != 0:
-                print(f"Build failed for preset={preset}, build_type={build_type}, stage={stage}")
-                return result.returncode
-
-            if(install):
-                print(f"\n=== Installing: preset={preset}, build_type={build_type}, stage={stage} ===")
-                install_cmd = [
-                    "cmake",
-                    "--install", str(build_dir),
-                    "--config", build_type
-                ]
-
-                result = subprocess.run(install_cmd, env=env, stdin=subprocess.DEVNULL)
-                if result.returncode != 0:
-                    print(f"Install failed for preset={preset}, build_type={build_type}, stage={stage}")
-                    return result.returncode
+    # Each (preset, build_type) pair writes to its own build_dir, so the
+    # matrix entries can run concurrently. Ninja's job count is divided
+    # between them so the matrix does not oversubscribe the machine.
+    matrix = [(preset, build_type) for preset in presets for build_type in build_types]
+
+    # Keep Ninja's job count explicit and consistent: honor MAX_JOBS /
+    # CMAKE_BUILD_PARALLEL_LEVEL when set, otherwise use all cores.
+    total_jobs = int(env.get("MAX_JOBS") or env.get("CMAKE_BUILD_PARALLEL_LEVEL") or os.cpu_count() or 1)
+    # Divide the job budget by the number of builds actually running at
+    # once, not the matrix size: with more entries than workers the
+    # concurrency is capped at max_workers.
+    max_workers = min(len(matrix), os.cpu_count() or 1)
+    jobs = str(max(1, total_jobs // max_workers))
+
+    # Argv pieces shared by every matrix entry, built once.
+    packages_str = ";".join(packages) if packages else ""
+    target_args = ("--target", *packages) if packages else ()
+
+    returncode = 0
+    with multiprocessing.Manager() as manager:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_set_stdout_lock, initargs=(manager.Lock(),)) as pool:
+            futures = {
+                pool.submit(build_one, preset, build_type, cmake_dir, base_build_dir,
+                            stage, packages_str, target_args, env, install, args.reconfigure, jobs): (preset, build_type)
+                for preset, build_type in matrix
+            }
+            for future in concurrent.futures.as_completed(futures):
+                preset, build_type = futures[future]
+                result = future.result()
+                if result != 0:
+                    print(f"\n=== Build matrix entry failed: preset={preset}, build_type={build_type}, stage={stage} ===")
+                    returncode = result
+
+    if returncode != 0:
+        return returncode
 
     print("\n=== All builds completed successfully ===")
     return 0
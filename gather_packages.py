@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""Gather package manifests into the workspace cache"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+try:
+    import fcntl
+except ImportError:  # non-Unix platforms
+    fcntl = None
+
+# Linux ioctl that clones src into dst on reflink filesystems (btrfs/XFS):
+# an O(1) metadata operation, no data is read or written.
+_FICLONE = 0x40049409
+
+# Prefer libyaml's C parser when PyYAML was built against it; the pure-Python
+# SafeLoader is an order of magnitude slower per file.
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+# Optional high-throughput backends for the small block-style package YAMLs.
+# pyfastyaml returns plain dicts directly; rapidyaml (ryml) parses in place
+# and we walk the tree ourselves. Both are strictly optional.
+_yaml_backend = None
+_yaml_fast = None
+try:
+    import pyfastyaml as _yaml_fast
+    _yaml_backend = 'pyfastyaml'
+except ImportError:
+    try:
+        import ryml as _yaml_fast
+        _yaml_backend = 'ryml'
+    except ImportError:
+        pass
+
+
+def load_manifest(manifest_path):
+    """Load a manifest file and return (manifest, manifest_dir)."""
+    manifest_path = Path(manifest_path).resolve()
+    # Hand the parser raw bytes: libyaml detects the encoding (and BOM)
+    # itself in C, skipping Python's incremental UTF-8 decode pass.
+    with open(manifest_path, 'rb') as f:
+        manifest = yaml.load(f, Loader=_Loader)
+    if not isinstance(manifest, dict):
+        raise ValueError(f"Invalid manifest file: {manifest_path}")
+    return manifest, manifest_path.parent
+
+
+def _load_cached_yaml(yaml_path, pickle_cache_dir):
+    """Return the cached parse of yaml_path, or None on a cache miss.
+
+    Cache entries are keyed by (absolute path, st_mtime_ns, st_size) so any
+    touch or rewrite of the source file invalidates them.
+    """
+    st = os.stat(yaml_path)
+    digest = hashlib.sha1(str(yaml_path).encode('utf-8')).hexdigest()
+    cache_file = pickle_cache_dir / f"{digest}.pickle"
+    try:
+        with open(cache_file, 'rb') as f:
+            mtime_ns, size, data = pickle.load(f)
+        if mtime_ns == st.st_mtime_ns and size == st.st_size:
+            return data
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+        pass
+    return None
+
+
+def _store_cached_yaml(yaml_path, pickle_cache_dir, data):
+    st = os.stat(yaml_path)
+    digest = hashlib.sha1(str(yaml_path).encode('utf-8')).hexdigest()
+    cache_file = pickle_cache_dir / f"{digest}.pickle"
+    try:
+        pickle_cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump((st.st_mtime_ns, st.st_size, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # the cache is best-effort; never fail the gather over it
+
+
+def _parse_package_yaml(content):
+    """Parse ArieoPackage.yaml content with the fastest available backend."""
+    if _yaml_backend == 'pyfastyaml':
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return _yaml_fast.loads(content)
+    if _yaml_backend == 'ryml':
+        buf = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+        tree = _yaml_fast.parse_in_arena(buf)
+        root = tree.root_id()
+        if not tree.is_map(root):
+            return None
+        # Walk only the top-level scalar fields ('name' is all the gather
+        # needs) instead of materializing the full document as Python objects.
+        data = {}
+        for child in _yaml_fast.children(tree, root):
+            if tree.has_key(child) and tree.has_val(child):
+                key = bytes(tree.key(child)).decode('utf-8')
+                data[key] = bytes(tree.val(child)).decode('utf-8')
+        return data
+    return yaml.load(content, Loader=_Loader)
+
+
+# [ \t]* (not \s*) so the match can never cross a line boundary: a
+# null-valued `name:` must fall back to the full parse, not capture the
+# following line. Anchored at offset 0 (no (?m)): a `name:` line deeper in
+# the file could be the continuation line of a multiline flow scalar, which
+# only the real parser can tell apart.
+_NAME_RE = re.compile(rb'\Aname[ \t]*:[ \t]*(\S.*?)[ \t]*(?:\r?\n|$)')
+_VAR_RE = re.compile(r'\$\{([^}]+)\}|\$(\w+)')
+
+
+def _expand_entry_path(path, subs):
+    """Expand ${VAR} and $VAR references in a manifest path in one pass.
+
+    subs is a prebuilt substitution table (environment plus
+    CUR_MANIFEST_FILE_DIR); unknown variables are left untouched.
+    """
+    return _VAR_RE.sub(lambda m: subs.get(m.group(1) or m.group(2), m.group(0)), path)
+
+
+def _extract_name_only(content):
+    """Fast-path 'name' extraction for block-style package YAML.
+
+    Covers the common case of `name: value` as the first line of the file
+    without building the full document. Returns None whenever the value
+    needs a real YAML parse (name not on the first line, quoting edge
+    cases, anchors, flow collections, trailing comments).
+    """
+    match = _NAME_RE.match(content)
+    if match is None:
+        return None
+    value = match.group(1)
+    if value[:1] in (b'"', b"'"):
+        if len(value) < 2 or value[-1:] != value[:1]:
+            return None
+        inner = value[1:-1]
+        # Escapes ("\"") and doubled quotes ('it''s') need real YAML
+        # unescaping; punt to the parser rather than return a wrong name.
+        if b'\\' in inner or value[:1] in inner:
+            return None
+        value = inner
+    elif b'#' in value or value[:1] in (b'&', b'*', b'[', b'{', b'|', b'>'):
+        return None
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def _skip_node(events, event):
+    """Consume the remaining events of a node whose first event is `event`."""
+    if isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent)):
+        return
+    depth = 1
+    for ev in events:
+        if isinstance(ev, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(ev, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _scan_name_events(content):
+    """Extract the top-level 'name' value from libyaml's event stream.
+
+    Returns (name, error). Walks only as many events as needed and skips
+    nested nodes wholesale, bypassing PyYAML's constructor machinery (tag
+    resolution, full object graph) entirely.
+    """
+    events = yaml.parse(content, Loader=_Loader)
+    try:
+        for event in events:
+            if isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+                continue
+            if not isinstance(event, yaml.MappingStartEvent):
+                return None, 'not-a-mapping'
+            break
+        else:
+            return None, 'not-a-mapping'
+        while True:
+            key_event = next(events)
+            if isinstance(key_event, yaml.MappingEndEvent):
+                return None, None  # no 'name' key in the document
+            if not isinstance(key_event, yaml.ScalarEvent):
+                _skip_node(events, key_event)
+                _skip_node(events, next(events))
+                continue
+            value_event = next(events)
+            if key_event.value == 'name':
+                if isinstance(value_event, yaml.ScalarEvent):
+                    return value_event.value, None
+                return None, 'name-not-scalar'
+            _skip_node(events, value_event)
+    except StopIteration:
+        return None, 'not-a-mapping'
+    except yaml.YAMLError as exc:
+        return None, str(exc)
+
+
+def verify_yaml(yaml_path, pickle_cache_dir=None):
+    """Verify an ArieoPackage.yaml file and return (parsed_data, error)."""
+    data = None
+    if pickle_cache_dir is not None:
+        data = _load_cached_yaml(yaml_path, pickle_cache_dir)
+    if data is None:
+        with open(yaml_path, 'rb') as f:
+            content = f.read()
+        if content.strip() == b'':
+            return None, f"Empty yaml file: {yaml_path}"
+        if _yaml_backend is not None:
+            # Backend exceptions are library-specific; map any of them to the
+            # same per-file error the CSafeLoader path reports.
+            try:
+                data = _parse_package_yaml(content)
+            except Exception as exc:
+                return None, f"Invalid yaml in {yaml_path}: {exc}"
+        else:
+            # Event-stream fast path: stop as soon as the top-level 'name'
+            # value has been read instead of constructing the whole document.
+            name, error = _scan_name_events(content)
+            if error == 'not-a-mapping':
+                return None, f"Root of {yaml_path} is not a mapping"
+            if error == 'name-not-scalar':
+                return None, f"Field 'name' in {yaml_path} is not a scalar"
+            if error is not None:
+                return None, f"Invalid yaml in {yaml_path}: {error}"
+            data = {'name': name} if name is not None else {}
+        if pickle_cache_dir is not None and data is not None:
+            _store_cached_yaml(yaml_path, pickle_cache_dir, data)
+    if not isinstance(data, dict):
+        return None, f"Root of {yaml_path} is not a mapping"
+    # An empty or whitespace-only name (e.g. name: '') is as useless as a
+    # missing one: downstream it would resolve to the cache root itself.
+    # This also guards cached pickle data, which replays through here.
+    name = data.get('name')
+    if name is None or not str(name).strip():
+        return None, f"Missing required field 'name' in {yaml_path}"
+    return data, None
+
+
+def _fast_copy(src, dst):
+    """Copy src to dst, preferring reflink/sendfile over a userspace read+write.
+
+    Tries FICLONE first, then zero-copy os.sendfile, then plain shutil.copy2.
+    Metadata is copied afterwards so the result matches copy2 semantics.
+    """
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                    shutil.copystat(src, dst)
+                    return
+                except OSError:
+                    pass  # not a reflink filesystem, or cross-device
+            if hasattr(os, 'sendfile'):
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                if offset >= size:
+                    shutil.copystat(src, dst)
+                    return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+
+
+# Guards the claimed-destinations set shared by worker threads.
+_claimed_lock = threading.Lock()
+
+
+def _process_entry(entry, package_path, cache_dir, pickle_cache_dir, claimed_dests, verbose):
+    """Verify and copy a single manifest entry.
+
+    Returns (status, messages) where status is 'copied', 'skipped',
+    'unchanged' or 'error'. Messages are collected rather than printed so
+    entries can run concurrently without interleaving their output.
+    """
+    messages = []
+
+    if 'git' in entry:
+        # Remote packages are synced by the CMake side, nothing to gather here
+        if verbose:
+            messages.append(f"Skipping git package: {entry['git']}")
+        return 'skipped', messages
+
+    if 'local' not in entry:
+        messages.append(f"Invalid manifest entry (expected 'local' or 'git'): {entry}")
+        return 'error', messages
+
+    arieo_yaml_path = package_path / "ArieoPackage.yaml"
+
+    # Open directly instead of exists()-then-open: one stat per entry on the
+    # happy path, with the not-found reason derived only when it fails.
+    try:
+        with open(arieo_yaml_path, 'rb') as f:
+            content = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        if package_path.exists():
+            messages.append(f"Missing ArieoPackage.yaml in {package_path}")
+        else:
+            messages.append(f"Package path does not exist: {package_path}")
+        return 'error', messages
+    except OSError as exc:
+        messages.append(f"Cannot read {arieo_yaml_path}: {exc}")
+        return 'error', messages
+
+    # Fast path: pull the single field the gather consumes straight out of
+    # the raw bytes; fall back to the full verify/parse when that fails.
+    name = _extract_name_only(content)
+    if name:
+        pkg_data = {'name': name}
+    else:
+        pkg_data, error = verify_yaml(arieo_yaml_path, pickle_cache_dir)
+        if error:
+            messages.append(error)
+            return 'error', messages
+    if verbose:
+        messages.append(f"Verified {arieo_yaml_path}: name={pkg_data['name']}")
+
+    pkg_name = pkg_data['name']
+    # Defense in depth: an empty name would make dest_folder the cache root.
+    if pkg_name is None or not str(pkg_name).strip():
+        messages.append(f"Missing required field 'name' in {arieo_yaml_path}")
+        return 'error', messages
+    dest_folder = cache_dir / pkg_name
+    # Two distinct package paths declaring the same name would race on one
+    # destination; claim it under the lock and fail the latecomer.
+    with _claimed_lock:
+        if dest_folder in claimed_dests:
+            messages.append(f"Duplicate package name '{pkg_name}' from {package_path}; destination already gathered")
+            return 'error', messages
+        claimed_dests.add(dest_folder)
+    dest_folder.mkdir(parents=True, exist_ok=True)
+    dest_path = dest_folder / "ArieoPackage.yaml"
+
+    # On warm runs the destination usually already matches the source; one
+    # extra stat is cheaper than re-copying (copystat preserves the source
+    # mtime, so an up-to-date copy has dest mtime >= source mtime).
+    try:
+        d = os.stat(dest_path)
+        s = os.stat(arieo_yaml_path)
+        if d.st_size == s.st_size and d.st_mtime_ns >= s.st_mtime_ns:
+            if verbose:
+                messages.append(f"Up to date: {dest_path}")
+            return 'unchanged', messages
+    except FileNotFoundError:
+        pass
+
+    # Map copy failures (permissions, ENOSPC, ...) to one per-entry error,
+    # matching how the read path reports its OSErrors.
+    try:
+        _fast_copy(arieo_yaml_path, dest_path)
+    except OSError as exc:
+        messages.append(f"Cannot copy {arieo_yaml_path} -> {dest_path}: {exc}")
+        return 'error', messages
+    if verbose:
+        messages.append(f"Copied {arieo_yaml_path} -> {dest_path}")
+    return 'copied', messages
+
+
+def gather_packages_from_manifest(manifest, manifest_dir, cache_dir, verbose=False):
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    pickle_cache_dir = cache_dir.parent / ".yaml_pickle_cache"
+
+    copied = 0
+    skipped = 0
+    unchanged = 0
+    duplicates = 0
+    errors = 0
+
+    # One substitution table for every entry; CUR_MANIFEST_FILE_DIR wins over
+    # any environment variable of the same name.
+    subs = {**os.environ, 'CUR_MANIFEST_FILE_DIR': str(manifest_dir)}
+    # An empty 'packages:' section parses as None; treat it like no packages.
+    entries = manifest.get('packages') or []
+    if not isinstance(entries, list):
+        print(f"Invalid manifest: 'packages' must be a list, got {type(entries).__name__}")
+        return copied, skipped, unchanged, duplicates, errors + 1
+    # Repeated local: entries (or two entries resolving to the same absolute
+    # path) would be parsed and copied once per occurrence; process each
+    # unique path only once.
+    seen_paths = set()
+    claimed_dests = set()
+    # Each entry is independent and the work is I/O-bound (stat, read,
+    # libyaml parse, copy), so threads give near-linear speedup here.
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = []
+        for entry in entries:
+            package_path = None
+            if 'local' in entry:
+                package_path = Path(_expand_entry_path(entry['local'], subs)).resolve()
+                if package_path in seen_paths:
+                    duplicates += 1
+                    if verbose:
+                        print(f"Skipping duplicate manifest entry: {package_path}")
+                    continue
+                seen_paths.add(package_path)
+            futures.append(pool.submit(_process_entry, entry, package_path, cache_dir,
+                                       pickle_cache_dir, claimed_dests, verbose))
+        for future in concurrent.futures.as_completed(futures):
+            status, messages = future.result()
+            for message in messages:
+                print(message)
+            if status == 'copied':
+                copied += 1
+            elif status == 'skipped':
+                skipped += 1
+            elif status == 'unchanged':
+                unchanged += 1
+            else:
+                errors += 1
+
+    return copied, skipped, unchanged, duplicates, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gather package manifests into the workspace cache")
+    parser.add_argument("--manifest", required=True, help="Path to packages.manifest.yaml")
+    parser.add_argument("--cache_dir", required=False, help="Cache output directory (default: <manifest_dir>/.cache/packages)")
+    parser.add_argument("--clean", action="store_true", help="Remove the cache directory before gathering")
+    parser.add_argument("--verbose", action="store_true", help="Verbose output")
+
+    args = parser.parse_args()
+
+    manifest_path = Path(args.manifest).resolve()
+    if not manifest_path.exists():
+        print(f"Manifest file does not exist: {manifest_path}")
+        return 1
+
+    try:
+        manifest, manifest_dir = load_manifest(manifest_path)
+    except (ValueError, yaml.YAMLError) as exc:
+        print(f"Failed to load manifest {manifest_path}: {exc}")
+        return 1
+    cache_dir = Path(args.cache_dir).resolve() if args.cache_dir else (manifest_dir / ".cache" / "packages")
+
+    cleanup_thread = None
+    if args.clean:
+        if cache_dir.exists():
+            # Renaming the old cache aside is O(1); the recursive delete then
+            # overlaps with the gather instead of blocking it up front. The
+            # pid+timestamp suffix cannot collide with leftovers from a
+            # previous (possibly killed) run.
+            trash = cache_dir.with_name(f"{cache_dir.name}.trash.{os.getpid()}.{time.time_ns()}")
+            try:
+                os.rename(cache_dir, trash)
+            except OSError:
+                shutil.rmtree(cache_dir)
+        # Reap our trash plus any stale one a killed run left behind.
+        trash_dirs = list(cache_dir.parent.glob(f"{cache_dir.name}.trash.*"))
+        if trash_dirs:
+            def _reap(paths):
+                for path in paths:
+                    shutil.rmtree(path, ignore_errors=True)
+            cleanup_thread = threading.Thread(target=_reap, args=(trash_dirs,))
+            cleanup_thread.start()
+
+    copied, skipped, unchanged, duplicates, errors = gather_packages_from_manifest(manifest, manifest_dir, cache_dir, args.verbose)
+
+    if cleanup_thread is not None:
+        cleanup_thread.join()
+
+    print(f"\n=== Gathered {copied} package(s), {unchanged} unchanged, skipped {skipped}, {duplicates} duplicate(s), {errors} error(s) ===")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())